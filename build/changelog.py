@@ -4,39 +4,119 @@ changelog.py helps generate the CHANGELOG.md message for a particular release.
 """
 
 import argparse
+import os
 import subprocess
-import shlex
 import re
 import urllib2
 import sys
 import json
+import time
+from multiprocessing.pool import ThreadPool
 
+EMAIL_RE = re.compile(r"<(.*@.*)>")
+FIXES_RE = re.compile(r"Fixes:?\s*#(\d+)")
+MAINTAINER_RE = re.compile(r"[^\s]+@[^\s]+")
+MAX_RETRY_DELAY = 60
+MAX_HTTP_CACHE_ENTRIES = 5000
 
-def run(cmd, *args, **kwargs):
-    return subprocess.check_output(shlex.split(cmd), *args, **kwargs).decode('utf-8')
 
+def run(*argv, **kwargs):
+    return subprocess.check_output(list(argv), **kwargs).decode('utf-8')
 
-def get_commit_ids(from_commit, to_commit):
-    cmd = "git log --format=%H --no-merges {from_commit}..{to_commit}"
-    commit_ids = run(cmd.format(from_commit=from_commit,
-                                to_commit=to_commit)).splitlines()
-    return commit_ids
 
+def iter_commits(from_commit, to_commit):
+    # Records end with an ASCII record separator (0x1e) and the id is
+    # separated from the message by a NUL, so an empty message still parses.
+    rev_range = "{from_commit}..{to_commit}".format(from_commit=from_commit, to_commit=to_commit)
+    out = run("git", "log", "--format=%H%x00%B%x1e", "--no-merges", rev_range)
+    for record in out.split("\x1e"):
+        record = record.lstrip("\n")
+        if not record:
+            continue
+        commit_id, _, commit_message = record.partition("\x00")
+        yield commit_id, commit_message
 
-def get_commit_message(commit_id):
-    cmd = "git log --format=%B --max-count=1 {commit_id}".format(
-        commit_id=commit_id)
-    return run(cmd)
 
+def rate_limit_delay(headers):
+    # Returns None when the request should not be retried, including when
+    # the limit resets too far in the future to be worth waiting for.
+    try:
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            delay = int(retry_after)
+        elif headers.get('X-RateLimit-Remaining') == '0':
+            reset = int(headers.get('X-RateLimit-Reset', 0))
+            delay = max(reset - int(time.time()), 0) + 1
+        else:
+            return None
+    except ValueError:
+        return None
+    if delay > MAX_RETRY_DELAY:
+        return None
+    return delay
+
+
+http_cache_path = os.path.expanduser("~/.cache/opa-changelog/http.json")
+
+
+def load_http_cache():
+    try:
+        with open(http_cache_path, "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+http_cache = load_http_cache()
+
+
+def save_http_cache():
+    # Keep only the most recently used entries so the file does not grow
+    # without bound from one release to the next.
+    urls = sorted(http_cache, key=lambda url: http_cache[url].get('used_at', 0), reverse=True)
+    entries = dict((url, http_cache[url]) for url in urls[:MAX_HTTP_CACHE_ENTRIES])
+    cache_dir = os.path.dirname(http_cache_path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(http_cache_path, "w") as f:
+        json.dump(entries, f)
+
+
+def cache_response(url, etag, body):
+    http_cache[url] = {'etag': etag, 'body': body, 'used_at': int(time.time())}
 
-def fetch(url, token):
+
+def fetch(url, token, summarize=None, immutable=False, retries=3):
+    # Responses are only cached when summarize is given; it reduces the body
+    # to the fields the caller reads so that the cache stays small. Cached
+    # immutable responses are returned without a request, others are
+    # revalidated with their ETag.
+    cached = http_cache.get(url) if summarize else None
+    if cached and immutable:
+        body = summarize(cached['body'])
+        cache_response(url, cached['etag'], body)
+        return body
     req = urllib2.Request(url)
     if token:
         req.add_header('Authorization', "token {}".format(token))
+    if cached and cached['etag']:
+        req.add_header('If-None-Match', cached['etag'])
     try:
         rsp = urllib2.urlopen(req)
         result = json.loads(rsp.read())
+        etag = rsp.info().getheader('ETag')
+        if summarize and (etag or immutable):
+            cache_response(url, etag, summarize(result))
     except Exception as e:
+        if cached and getattr(e, 'code', None) == 304:
+            body = summarize(cached['body'])
+            cache_response(url, cached['etag'], body)
+            return body
+        if getattr(e, 'code', None) in (403, 429) and retries > 0:
+            delay = rate_limit_delay(e.info())
+            if delay is not None:
+                print >> sys.stderr, 'Failed to fetch URL {}: Code {}; retrying in {}s'.format(url, e.code, delay)
+                time.sleep(delay)
+                return fetch(url, token, summarize, immutable, retries - 1)
         if hasattr(e, 'reason'):
             print >> sys.stderr, 'Failed to fetch URL {}: {}'.format(url, e.reason)
         elif hasattr(e, 'code'):
@@ -49,7 +129,7 @@ def fetch(url, token):
 def get_maintainers():
     with open("MAINTAINERS.md", "r") as f:
         contents = f.read()
-    maintainers = re.findall(r"[^\s]+@[^\s]+", contents)
+    maintainers = MAINTAINER_RE.findall(contents)
     return maintainers
 
 maintainers = get_maintainers()
@@ -61,27 +141,55 @@ def is_maintainer(commit_message):
 
 
 def author_email(commit_message):
-    match = re.search(r"<(.*@.*)>", commit_message)
+    match = EMAIL_RE.search(commit_message)
     if match:
         author = match.group(1)
         return str(author)
     return ""
 
+
+def commit_author(commit):
+    author = commit.get('author') or {}
+    return {'author': {'login': author.get('login', '')}}
+
+# Failed lookups are recorded as "" so that an author is only looked up once
+# per run.
 github_ids = {}
 def get_github_id(commit_message, commit_id, token):
     email = author_email(commit_message)
-    if github_ids.get(email, ""):
+    if not email:
+        return ""
+    if email in github_ids:
         return github_ids[email]
     url = "https://api.github.com/repos/open-policy-agent/opa/commits/{}".format(commit_id)
-    r = fetch(url, token)
-    author = r.get('author', {})
-    if author is None:
-        return ""
+    # The author of a commit never changes, so a cached lookup is final.
+    r = fetch(url, token, commit_author, immutable=True)
+    author = r.get('author') or {}
     login = author.get('login', '')
-    if login:
-        github_ids[email]=login
-        return login
-    return ""
+    github_ids[email] = login
+    return login
+
+
+def needs_mention(commit_message):
+    return fixes_issue_id(commit_message) and not is_maintainer(commit_message)
+
+
+def prefetch_github_ids(commits, token, workers=8):
+    # Look up one commit per distinct author to be mentioned concurrently so
+    # that mention_author() is served from github_ids afterwards.
+    pending = {}
+    for commit_id, commit_message in commits:
+        if not needs_mention(commit_message):
+            continue
+        pending.setdefault(author_email(commit_message), (commit_message, commit_id))
+    if not pending:
+        return
+    pool = ThreadPool(workers)
+    try:
+        pool.map(lambda c: get_github_id(c[0], c[1], token), pending.values())
+    finally:
+        pool.close()
+        pool.join()
 
 
 def mention_author(commit_message, commit_id, token):
@@ -92,13 +200,14 @@ def mention_author(commit_message, commit_id, token):
 
 
 def fixes_issue_id(commit_message):
-    match = re.search(r"Fixes:?\s*#(\d+)", commit_message)
+    match = FIXES_RE.search(commit_message)
     if match:
         return match.group(1)
 
 
 def get_subject(commit_message):
-    return commit_message.splitlines()[0]
+    lines = commit_message.splitlines()
+    return lines[0] if lines else ""
 
 
 def get_changelog_message(commit_message, mention, repo_url):
@@ -110,8 +219,7 @@ def get_changelog_message(commit_message, mention, repo_url):
 
 
 def get_latest_tag():
-    cmd = "git describe --tags --first-parent"
-    return run(cmd).split('-')[0]
+    return run("git", "describe", "--tags", "--first-parent").split('-')[0]
 
 
 def parse_args():
@@ -130,10 +238,11 @@ def main():
 
     args = parse_args()
     changelog = {}
-    for commit_id in get_commit_ids(args.from_version, args.to_commit):
+    commits = list(iter_commits(args.from_version, args.to_commit))
+    prefetch_github_ids(commits, args.token)
+    for commit_id, commit_message in commits:
         mention = ""
-        commit_message = get_commit_message(commit_id)
-        if not is_maintainer(commit_message):
+        if needs_mention(commit_message):
             mention = mention_author(commit_message, commit_id, args.token)
         group, line = get_changelog_message(commit_message, mention, args.repo_url)
         changelog.setdefault(group, []).append(line)
@@ -151,6 +260,8 @@ def main():
         for line in sorted(changelog[None]):
             print("- {}".format(line))
 
+    save_http_cache()
+
 
 if __name__ == "__main__":
     main()